@@ -1,26 +1,88 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import argparse, datetime as dt, json, os, sys, ssl, urllib.parse, urllib.request
+# Na górze tylko to, czego potrzebuje przerwa nocna; argparse/ssl/http/json importowane dopiero przy użyciu.
+import datetime as dt, os, sys
 
 # ---------- SSL ----------
+# kontekst budowany raz na proces dla danej wartości `insecure` (parsowanie paczki CA jest kosztowne)
+_SSL_CTX: dict = {}
+
 def make_ssl_context(insecure: bool):
+    ctx = _SSL_CTX.get(insecure)
+    if ctx is None:
+        ctx = _SSL_CTX[insecure] = _build_ssl_context(insecure)
+    return ctx
+
+def _build_ssl_context(insecure: bool):
+    import ssl
     if insecure:
         return ssl._create_unverified_context()
+    if ssl.get_default_verify_paths().cafile:
+        # systemowy magazyn certyfikatów istnieje – certifi niepotrzebne
+        return ssl.create_default_context()
     try:
         import certifi
         return ssl.create_default_context(cafile=certifi.where())
     except Exception:
         return ssl.create_default_context()
 
+# ---------- JSON ----------
+# orjson opcjonalnie – szybsze (de)serializowanie odpowiedzi API i pliku stanu.
+# Backend wybierany raz, przy pierwszym użyciu: None = jeszcze nie sprawdzono, False = brak orjson.
+_orjson = None
+
+def _fast_json():
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson as _orjson
+        except ImportError:
+            _orjson = False
+    return _orjson
+
+def json_loads(data: bytes):
+    fast = _fast_json()
+    if fast:
+        return fast.loads(data)
+    import json
+    return json.loads(data)
+
+def json_dumps(obj) -> bytes:
+    fast = _fast_json()
+    if fast:
+        return fast.dumps(obj)
+    import json
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# ---------- HTTP ----------
+USER_AGENT = "pogoda-alert"
+
+def http_request(method: str, url: str, ctx, timeout: float, body: bytes | None = None,
+                 headers: dict | None = None) -> bytes:
+    import urllib.request
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip", **(headers or {})}
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    with urllib.request.urlopen(req, timeout=timeout, context=ctx) as resp:
+        data = resp.read()
+        if resp.headers.get("Content-Encoding", "").lower() == "gzip":
+            import gzip
+            data = gzip.decompress(data)
+    return data
+
 # ---------- API ----------
 GEO_URL = "https://geocoding-api.open-meteo.com/v1/search"
 FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+# stałe części zapytań zakodowane raz – przy wywołaniu kodowane są tylko zmienne wartości
+GEO_QUERY = GEO_URL + "?name={name}&count=1&language=pl&format=json"
+FORECAST_QUERY = (FORECAST_URL + "?latitude={lat}&longitude={lon}"
+                  "&hourly=precipitation%2Cprecipitation_probability"
+                  "&timezone={tz}&start_hour={start}&end_hour={end}")
+GEO_CACHE_TTL = 30 * 24 * 3600  # s – współrzędne miasta praktycznie się nie zmieniają
 
 def geocode_city(city: str, ctx) -> dict:
-    params = {"name": city, "count": 1, "language": "pl", "format": "json"}
-    url = GEO_URL + "?" + urllib.parse.urlencode(params)
-    with urllib.request.urlopen(url, timeout=15, context=ctx) as resp:
-        data = json.load(resp)
+    import urllib.parse
+    url = GEO_QUERY.format(name=urllib.parse.quote(city, safe=""))
+    data = json_loads(http_request("GET", url, ctx, timeout=15))
     results = data.get("results") or []
     if not results:
         raise SystemExit(f"Nie znaleziono lokalizacji dla: {city}")
@@ -33,25 +95,55 @@ def geocode_city(city: str, ctx) -> dict:
         "timezone": r.get("timezone", "auto"),
     }
 
-def fetch_forecast(lat: float, lon: float, tz: str, ctx) -> dict:
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "hourly": "temperature_2m,precipitation,precipitation_probability",
-        "timezone": tz,
-        "forecast_days": 2,
-    }
-    url = FORECAST_URL + "?" + urllib.parse.urlencode(params)
-    with urllib.request.urlopen(url, timeout=20, context=ctx) as resp:
-        return json.load(resp)
+def fetch_forecast(lat: float, lon: float, tz: str, now: dt.datetime, ctx) -> dict:
+    import urllib.parse
+    # tylko godziny obejmujące okno [now, now + 24h] zamiast dwóch pełnych dni
+    start = now.strftime("%Y-%m-%dT%H:00")
+    end = (now + dt.timedelta(hours=24)).strftime("%Y-%m-%dT%H:00")
+    url = FORECAST_QUERY.format(lat=lat, lon=lon, tz=urllib.parse.quote(tz, safe=""), start=start, end=end)
+    return json_loads(http_request("GET", url, ctx, timeout=20))
 
 # ---------- Pomocnicze ----------
-def next24_indices(times_iso: list[str], now: dt.datetime) -> list[int]:
-    parsed = [dt.datetime.fromisoformat(t) for t in times_iso]
-    end = now + dt.timedelta(hours=24)
-    return [i for i, t in enumerate(parsed) if now <= t <= end]
+def scan_rain(times: list[str], precip_prob: list, precip_mm: list, now: dt.datetime,
+              thr_prob: float, thr_mm: float):
+    # Jeden przebieg: filtr okna [now, now + 24h] + oba maksima + pierwsza godzina z deszczem.
+    # Zwraca (wiersze (czas, prawd, mm) z okna, max prawd, max mm, czas pierwszej godziny z deszczem | None).
+    # "YYYY-MM-DDTHH:MM" z Open-Meteo sortuje się leksykalnie jak czas – porównujemy napisy, bez parsowania
+    lo_dt = now.replace(second=0, microsecond=0)
+    if lo_dt < now:
+        lo_dt += dt.timedelta(minutes=1)  # zaokrąglenie w górę, żeby zachować warunek t >= now
+    lo = lo_dt.strftime("%Y-%m-%dT%H:%M")
+    hi = (now + dt.timedelta(hours=24)).strftime("%Y-%m-%dT%H:%M")
+    rows = []
+    max_prob = max_mm = 0.0
+    first_rain = None
+    for t, p, m in zip(times, precip_prob, precip_mm):
+        if not (lo <= t <= hi):
+            continue
+        p = _to_float(p, 0.0)
+        m = _to_float(m, 0.0)
+        rows.append((t, p, m))
+        if p > max_prob:
+            max_prob = p
+        if m > max_mm:
+            max_mm = m
+        if first_rain is None and (p >= thr_prob or m >= thr_mm):
+            first_rain = t
+    return rows, max_prob, max_mm, first_rain
+
+def _parse_iso(s) -> dt.datetime | None:
+    # uszkodzona wartość (np. ręcznie edytowany stan) => None zamiast wyjątku
+    try:
+        return dt.datetime.fromisoformat(s)
+    except (TypeError, ValueError):
+        return None
 
 def _to_float(x, default=0.0):
+    # Open-Meteo zwraca float albo None (brak danych) – te przypadki bez try/except
+    if type(x) is float:
+        return x
+    if x is None:
+        return float(default)
     try:
         return float(x)
     except Exception:
@@ -66,28 +158,51 @@ def load_state() -> dict:
     p = state_path()
     if os.path.exists(p):
         try:
-            with open(p, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(p, "rb") as f:
+                return json_loads(f.read())
         except Exception:
             pass
     # domyślny stan – None => pierwsze uruchomienie
-    return {"rain_state": None, "rain_count": 0}
+    return {"rain_state": None, "rain_count": 0, "geocode": {}}
 
 def save_state(st: dict):
-    with open(state_path(), "w", encoding="utf-8") as f:
-        json.dump(st, f, ensure_ascii=False, indent=2)
+    # zapis atomowy: plik tymczasowy + fsync + os.replace (przerwany bieg nie zostawi pustego pliku)
+    payload = json_dumps(st)
+    p = state_path()
+    tmp = p + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(payload)  # BufferedWriter zapisuje całość (surowy FileIO mógłby zapisać tylko część)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, p)
+    except Exception:
+        # nie zostawiaj po sobie niepełnego pliku tymczasowego
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
 
 # ---------- Telegram ----------
 def send_telegram(token: str, chat_id: str, text: str, ctx):
     api = f"https://api.telegram.org/bot{token}/sendMessage"
-    params = {"chat_id": chat_id, "text": text, "disable_web_page_preview": "true"}
-    data = urllib.parse.urlencode(params).encode("utf-8")
-    req = urllib.request.Request(api, data=data, method="POST")
-    with urllib.request.urlopen(req, timeout=15, context=ctx) as resp:
-        _ = resp.read()
+    params = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
+    data = json_dumps(params)
+    headers = {"Content-Type": "application/json"}
+    http_request("POST", api, ctx, timeout=15, body=data, headers=headers)
 
 # ---------- Główna logika ----------
 def main():
+    now = dt.datetime.now().replace(microsecond=0)
+
+    # Przerwa nocna 22:00–06:59 (żeby bieg 07:00 już działał) – sprawdzana jeszcze przed argparse,
+    # bo to najczęstszy bieg bez żadnej pracy; --help działa zawsze
+    if (now.hour >= 22 or now.hour < 7) and not {"-h", "--help"} & set(sys.argv[1:]):
+        print(f"{now} – przerwa nocna (22:00–06:59), skrypt kończy pracę.")
+        sys.exit(0)
+
+    import argparse
     ap = argparse.ArgumentParser(description="Pogoda alert: deszcz (z debounce i status na 1. uruchomieniu)")
     ap.add_argument("--miasto", required=True)
     ap.add_argument("--prog-opad", type=int, default=50, help="Próg prawd. opadu w % (alert, gdy >= próg)")
@@ -97,26 +212,39 @@ def main():
     ap.add_argument("--insecure", action="store_true", help="Wyłącz weryfikację SSL (awaryjnie)")
     args = ap.parse_args()
 
-    ctx = make_ssl_context(args.insecure)
-    now = dt.datetime.now().replace(microsecond=0)
-
-    # Przerwa nocna 22:00–06:59 (żeby bieg 07:00 już działał)
-    if now.hour >= 22 or now.hour < 7:
-        print(f"{now} – przerwa nocna (22:00–06:59), skrypt kończy pracę.")
-        sys.exit(0)
-
     # parametry "złotego środka"
     DEBOUNCE_NEED = 2       # ile kolejnych wykryć "deszcz" potrzeba, by wysłać alert
     IMMEDIATE_MM  = 2.0     # jeśli max_mm >= IMMEDIATE_MM -> wyślij natychmiast
+    RAIN_SOON     = dt.timedelta(hours=6)     # deszcz bliżej niż to -> sprawdzaj częściej
+    RECHECK_SOON  = dt.timedelta(minutes=10)  # odstęp, gdy deszcz blisko lub czeka na potwierdzenie
+    RECHECK_LATER = dt.timedelta(minutes=30)  # odstęp, gdy w najbliższych godzinach spokój
 
     # Stan
     st = load_state()
     prev_rain  = st.get("rain_state", None)   # None => pierwsze uruchomienie
     rain_count = int(st.get("rain_count", 0))
 
-    # Prognoza
-    loc = geocode_city(args.miasto, ctx)
-    fc = fetch_forecast(loc["latitude"], loc["longitude"], loc["timezone"], ctx)
+    # Niedawne sprawdzenie z tymi samymi parametrami bez zbliżającej się zmiany – zmiana stanu jeszcze
+    # nie mogła nastąpić. Ręczne uruchomienie (workflow_dispatch) zawsze sprawdza.
+    check_args = [args.miasto.strip().lower(), args.prog_opad, args.prog_mm, args.tg_chat]
+    next_check = _parse_iso(st.get("next_check_after"))
+    if (next_check and now < next_check
+            and st.get("last_check_args") == check_args
+            and os.environ.get("GITHUB_EVENT_NAME") != "workflow_dispatch"):
+        print(f"{now} – ostatnie sprawdzenie {st.get('last_check_ts')}, kolejne po {next_check.isoformat()}; pomijam.")
+        sys.exit(0)
+
+    # Prognoza (wynik geokodowania trzymany w stanie, odświeżany co GEO_CACHE_TTL)
+    # kontekst SSL powstaje dopiero przy pierwszym żądaniu sieciowym (make_ssl_context zapamiętuje kontekst)
+    geo_key = f"{args.miasto.strip().lower()}|pl"
+    loc = (st.get("geocode") or {}).get(geo_key)
+    if not loc or now.timestamp() - loc.get("fetched_at", 0) >= GEO_CACHE_TTL:
+        loc = geocode_city(args.miasto, make_ssl_context(args.insecure))
+        loc["fetched_at"] = int(now.timestamp())
+    st["geocode"] = {geo_key: loc}  # tylko bieżące miasto – wpisy innych miast nie zostają w stanie
+
+    fc = fetch_forecast(loc["latitude"], loc["longitude"], loc["timezone"], now,
+                        make_ssl_context(args.insecure))
     times = fc["hourly"]["time"]
     precip_mm   = fc["hourly"].get("precipitation", [0]*len(times))
     precip_prob = fc["hourly"].get("precipitation_probability", [0]*len(times))
@@ -126,25 +254,20 @@ def main():
     print("-" * len(header))
 
     # Okno 24h
-    idxs = next24_indices(times, now)
-    vals = []
-    for i in idxs:
-        p = _to_float(precip_prob[i] if i < len(precip_prob) else 0.0, 0.0)
-        m = _to_float(precip_mm[i]   if i < len(precip_mm)   else 0.0, 0.0)
-        vals.append((p, m))
+    rows, max_prob, max_mm, first_rain = scan_rain(times, precip_prob, precip_mm, now,
+                                                   float(args.prog_opad), float(args.prog_mm))
 
-    max_prob = max((p for p, _ in vals), default=0.0)
-    max_mm   = max((m for _, m in vals), default=0.0)
-
-    detected_now = (max_prob >= float(args.prog_opad)) or (max_mm >= float(args.prog_mm))
+    detected_now = first_rain is not None
     print(f"Status deszczu 24h: {'będzie' if detected_now else 'brak'} "
           f"(max prawd={int(max_prob)}%, max opad={max_mm:.1f} mm, progi: {int(args.prog_opad)}%, {args.prog_mm} mm)")
+    if detected_now:
+        print(f"Początek deszczu (pierwsza godzina powyżej progu): {first_rain}")
 
-    # szczegóły (krótko)
-    for i in idxs[:24]:  # wypisz max 24 wiersze, żeby nie zalewać logów
-        prob = _to_float(precip_prob[i] if i < len(precip_prob) else 0.0, 0.0)
-        mm   = _to_float(precip_mm[i]   if i < len(precip_mm)   else 0.0, 0.0)
-        print(f"  {times[i]}: opad={mm:.1f} mm, prawd={int(prob)}%")
+    # szczegóły (krótko) – wiersze już przefiltrowane i przeliczone w scan_rain
+    lines = [f"  {t}: opad={mm:.1f} mm, prawd={int(prob)}%"
+             for t, prob, mm in rows[:24]]  # max 24 wiersze, żeby nie zalewać logów
+    if lines:
+        print("\n".join(lines))  # jeden zapis zamiast 24 wywołań print()
 
     # Debounce i decyzja powiadomienia
     send_rain = False
@@ -190,10 +313,19 @@ def main():
 
         st["rain_count"] = rain_count
 
+    # Termin kolejnego sprawdzenia
+    # nieczytelny czas początku deszczu traktujemy ostrożnie, jak deszcz blisko
+    rain_at = _parse_iso(first_rain) if first_rain is not None else None
+    rain_soon = first_rain is not None and (rain_at is None or rain_at - now <= RAIN_SOON)
+    pending = detected_now and not st["rain_state"]
+    st["last_check_ts"] = now.isoformat()
+    st["last_check_args"] = check_args
+    st["next_check_after"] = (now + (RECHECK_SOON if rain_soon or pending else RECHECK_LATER)).isoformat()
+
     # Wysyłka
     if send_rain and msg and args.tg_token and args.tg_chat:
         try:
-            send_telegram(args.tg_token, args.tg_chat, f"[{loc['name']}] {msg}", ctx)
+            send_telegram(args.tg_token, args.tg_chat, f"[{loc['name']}] {msg}", make_ssl_context(args.insecure))
             print(f"Wysłano powiadomienie do {args.tg_chat}: {msg}")
         except Exception as e:
             print(f"Błąd wysyłki (Telegram): {e}", file=sys.stderr)